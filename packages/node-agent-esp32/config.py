@@ -25,3 +25,6 @@ RECONNECT_MAX = 60
 # ─── GPIO Pins (customize for your board) ────────────────
 LED_PIN = 2          # Built-in LED (most ESP32 boards)
 SENSOR_PIN = None    # Set to GPIO number if DHT22/etc attached
+
+# ─── Debug ───────────────────────────────────────────────
+DEBUG = False        # Print incoming commands, AI responses and relays
@@ -9,82 +9,334 @@ import os
 import sys
 import network
 import ubinascii
-import uwebsocket
 import usocket
+import uselect
 
 import config
 
 VERSION = "0.1.0"
 
+# Older config.py files predate the DEBUG setting
+_DEBUG = getattr(config, "DEBUG", False)
+
+_WLAN_STA = network.WLAN(network.STA_IF)
+
+# Fixed-shape messages are pre-serialized; only their varying fields are
+# formatted in, so heartbeats and pongs skip ujson.dumps entirely.
+_PING_TMPL = b'{"type":"ping","ts":%d}'
+_PONG_TMPL = b'{"type":"pong","ts":%d}'
+_SYSINFO_TMPL = b'{"type":"sysinfo","ts":%d,"info":%s}'
+
+# Command results carry arbitrary strings that need JSON escaping, so this one
+# stays a dict, filled in place before each send.
+_CMD_RESULT = {
+    "type": "command_result",
+    "ts": 0,
+    "replyTo": "",
+    "exitCode": 0,
+    "stdout": "",
+    "stderr": "",
+    "durationMs": 0,
+}
+
+# Scratch buffer for incoming frames, reused by every connection. Frames are
+# parsed in place; a message that does not fit gets a buffer of exactly its
+# size, which is dropped again once the message has been handled.
+_RX_BUF = bytearray(2048)
+_RX_MV = memoryview(_RX_BUF)
+
+# Optional modules (esp32, dht, ...) imported on first use; None when missing.
+_MODS = {}
+_CAPS_CACHE = None
+
+# Reused by collect_sysinfo(); filesystem geometry is read once and the CPU
+# frequency is cached until the freq command changes it.
+_SYSINFO_INFO = {}
+_FS_BSIZE = 0
+_DISK_TOTAL_MB = 0
+_FREQ_MHZ = None
+
+# TLS context shared by every reconnect. Only the context setup is saved;
+# each connection still performs a full handshake.
+_SSL_CTX = None
+
+# Wall-clock anchor for message timestamps. The RTC is read only when the
+# anchor is (re)set; every other timestamp is a ticks offset from it.
+_EPOCH_BASE_MS = 0
+_TICKS_BASE = 0
+
+_WS_WRITE_TIMEOUT = 10    # Seconds a frame write may block
+_WS_MAX_MESSAGE = 16384   # Larger incoming messages are skipped
+
+_WS_HANDSHAKE = (
+    b"GET %s HTTP/1.1\r\n"
+    b"Host: %s:%d\r\n"
+    b"Upgrade: websocket\r\n"
+    b"Connection: Upgrade\r\n"
+    b"Sec-WebSocket-Key: %s\r\n"
+    b"Sec-WebSocket-Version: 13\r\n"
+    b"\r\n"
+)
+
 # ─── WebSocket Helpers ────────────────────────────────────
 
+def ssl_wrap(sock, host):
+    """Wrap a socket in TLS, reusing one SSLContext across reconnects."""
+    global _SSL_CTX
+    import ussl
+
+    # Older firmware only has the module-level wrap_socket
+    if not hasattr(ussl, "SSLContext"):
+        return ussl.wrap_socket(sock, server_hostname=host)
+
+    if _SSL_CTX is None:
+        _SSL_CTX = ussl.SSLContext(ussl.PROTOCOL_TLS_CLIENT)
+        _SSL_CTX.verify_mode = ussl.CERT_NONE  # Same as ussl.wrap_socket default
+
+    return _SSL_CTX.wrap_socket(sock, server_hostname=host)
+
+
+class WebSocket:
+    """Client side of RFC 6455 framing over a plain or TLS socket.
+
+    Reads are non-blocking and return one message per frame, however the
+    bytes arrive. Writes are masked, as clients must, and block for at most
+    _WS_WRITE_TIMEOUT seconds so a half-open link cannot hang the agent.
+    """
+
+    def __init__(self, sock, raw):
+        self.sock = sock  # Socket used for I/O (TLS-wrapped when ssl=True)
+        self.raw = raw    # Underlying TCP socket, where timeouts are set
+        self.buf = _RX_BUF
+        self.mv = _RX_MV
+        self.start = 0    # Unparsed bytes are buf[start:end]
+        self.end = 0
+        self.skip = 0     # Bytes of an oversized message still to discard
+        raw.setblocking(False)
+
+    def recv(self):
+        """Return the payload of the next complete message, or None."""
+        while True:
+            payload = self._next_frame()
+            if payload is not None:
+                return payload
+            if not self._fill():
+                return None
+
+    def send(self, payload, opcode=0x1):
+        """Send one frame (text by default); raises OSError on timeout."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        size = len(payload)
+        if size < 126:
+            frame = bytearray(6 + size)
+            frame[1] = 0x80 | size
+            pos = 2
+        elif size < 65536:
+            frame = bytearray(8 + size)
+            frame[1] = 0x80 | 126
+            frame[2] = size >> 8
+            frame[3] = size & 0xFF
+            pos = 4
+        else:
+            frame = bytearray(14 + size)
+            frame[1] = 0x80 | 127
+            frame[2:10] = size.to_bytes(8, "big")
+            pos = 10
+        frame[0] = 0x80 | opcode
+        mask = os.urandom(4)
+        frame[pos:pos + 4] = mask
+        pos += 4
+        # Mask as one big-integer XOR against the repeated key, which runs in
+        # C rather than as a bytecode loop per payload byte
+        if size:
+            reps = (size + 3) >> 2
+            key = int.from_bytes(mask * reps, "big") >> (8 * ((reps << 2) - size))
+            frame[pos:] = (int.from_bytes(payload, "big") ^ key).to_bytes(size, "big")
+
+        self.raw.settimeout(_WS_WRITE_TIMEOUT)
+        try:
+            self.sock.write(frame)
+        finally:
+            self.raw.setblocking(False)
+
+    def close(self):
+        self.sock.close()
+
+    def _fill(self):
+        """Read whatever the socket has ready; False if nothing was read."""
+        mv = self.mv
+        while self.skip:
+            n = self.sock.readinto(mv[:min(self.skip, len(mv))])
+            if n is None:
+                return False
+            if n == 0:
+                raise OSError("Connection closed by Gateway")
+            self.skip -= n
+
+        if self.start:
+            # Move a partly received frame to the front to make room
+            tail = self.end - self.start
+            self.buf[:tail] = bytes(mv[self.start:self.end])
+            self.start = 0
+            self.end = tail
+
+        n = self.sock.readinto(mv[self.end:])
+        if n is None:
+            return False  # Nothing to read yet
+        if n == 0:
+            raise OSError("Connection closed by Gateway")
+        self.end += n
+        return True
+
+    def _next_frame(self):
+        """Consume the next complete data frame and return its payload as a
+        memoryview into the receive buffer (valid until the next recv());
+        None if no complete frame is buffered."""
+        while self.end - self.start >= 2:
+            buf = self.buf
+            start = self.start
+            avail = self.end - start
+            fin = buf[start] & 0x80
+            opcode = buf[start] & 0x0F
+            size = buf[start + 1] & 0x7F
+            pos = 2
+            if size == 126:
+                if avail < 4:
+                    return None
+                size = (buf[start + 2] << 8) | buf[start + 3]
+                pos = 4
+            elif size == 127:
+                if avail < 10:
+                    return None
+                size = int.from_bytes(bytes(buf[start + 2:start + 10]), "big")
+                pos = 10
+            if buf[start + 1] & 0x80:
+                raise OSError("WebSocket protocol error: masked server frame")
+            end = pos + size
+
+            if size > _WS_MAX_MESSAGE:
+                # The Gateway relays payloads up to 1 MB; drop this one
+                # without buffering it and keep the connection.
+                print("[ForgeAI] Dropped oversized message (%d bytes)" % size)
+                if avail < end:
+                    self.skip = end - avail
+                    self.start = self.end = 0
+                    return None
+                self.start = start + end
+                continue
+
+            if avail < end:
+                if end > len(buf):
+                    # Give the frame a buffer of its own, exactly its size. A
+                    # new bytearray, because resizing one with a live
+                    # memoryview would leave the view on freed memory.
+                    grown = bytearray(end)
+                    grown[:avail] = self.mv[start:self.end]
+                    self.buf = grown
+                    self.mv = memoryview(grown)
+                    self.start = 0
+                    self.end = avail
+                return None
+
+            payload = self.mv[start + pos:start + end]
+            self.start = start + end
+            if self.start == self.end:
+                self.start = self.end = 0
+                if buf is not _RX_BUF:
+                    # Back to the scratch buffer; payload keeps the grown
+                    # one alive only until the caller is done with it.
+                    self.buf = _RX_BUF
+                    self.mv = _RX_MV
+
+            if opcode == 0x8:
+                raise OSError("Connection closed by Gateway")
+            if opcode == 0x9:
+                self.send(payload, 0xA)  # Answer ping with pong
+                continue
+            if opcode == 0xA:
+                continue
+            if not fin or opcode == 0x0:
+                raise OSError("WebSocket protocol error: fragmented message")
+            return payload
+        return None
+
+
 def ws_connect(host, port, path, ssl=False):
     """Create a WebSocket connection manually (MicroPython compatible)."""
     addr = usocket.getaddrinfo(host, port)[0][-1]
-    sock = usocket.socket()
+    raw = sock = usocket.socket()
     sock.settimeout(10)
     sock.connect(addr)
 
     if ssl:
-        import ussl
-        sock = ussl.wrap_socket(sock, server_hostname=host)
+        sock = ssl_wrap(sock, host)
 
     # WebSocket handshake
-    key = ubinascii.b2a_base64(os.urandom(16)).strip()
-    handshake = (
-        "GET %s HTTP/1.1\r\n"
-        "Host: %s:%d\r\n"
-        "Upgrade: websocket\r\n"
-        "Connection: Upgrade\r\n"
-        "Sec-WebSocket-Key: %s\r\n"
-        "Sec-WebSocket-Version: 13\r\n"
-        "\r\n"
-    ) % (path, host, port, key.decode())
-
-    sock.send(handshake.encode())
-
-    # Read response headers
-    header = b""
-    while b"\r\n\r\n" not in header:
-        chunk = sock.recv(1)
+    # 16 random bytes always encode to 24 base64 chars plus a trailing newline
+    key = ubinascii.b2a_base64(os.urandom(16))[:24]
+    sock.send(_WS_HANDSHAKE % (path.encode(), host.encode(), port, key))
+
+    # Read response headers. The Gateway stays silent until it receives auth,
+    # so reading in chunks cannot swallow the first WebSocket frame.
+    header = bytearray()
+    while header.find(b"\r\n\r\n") < 0:
+        chunk = sock.recv(256)
         if not chunk:
             raise OSError("WebSocket handshake failed: no response")
-        header += chunk
+        header.extend(chunk)
 
-    if b"101" not in header:
+    if header.find(b"101") < 0:
         sock.close()
-        raise OSError("WebSocket handshake failed: %s" % header[:80].decode())
+        raise OSError("WebSocket handshake failed: %s" % bytes(header[:80]).decode())
 
-    # Wrap in uwebsocket
-    ws = uwebsocket.websocket(sock)
-    return ws, sock
+    return WebSocket(sock, raw), sock
 
 
 def ws_send_json(ws, data):
     """Send a JSON message over WebSocket."""
-    payload = ujson.dumps(data)
-    ws.write(payload)
+    ws.send(ujson.dumps(data))
 
 
 def ws_recv_json(ws, timeout_ms=100):
-    """Try to receive a JSON message from WebSocket (non-blocking)."""
-    try:
-        data = ws.read()
-        if data:
-            return ujson.loads(data)
-    except OSError:
-        pass
-    return None
+    """Try to receive a JSON message from WebSocket (non-blocking).
+
+    Returns one message per call, or None when no complete message has
+    arrived yet; raises OSError once the Gateway has closed the connection.
+    Malformed messages are logged and skipped.
+    """
+    while True:
+        payload = ws.recv()
+        if payload is None:
+            return None
+        try:
+            return ujson.loads(payload)
+        except ValueError:
+            print("[ForgeAI] Dropped malformed message (%d bytes)" % len(payload))
 
 
 # ─── System Info ──────────────────────────────────────────
 
+def epoch_ms():
+    """Wall-clock milliseconds for outgoing message timestamps."""
+    global _EPOCH_BASE_MS, _TICKS_BASE
+    now = utime.ticks_ms()
+    elapsed = utime.ticks_diff(now, _TICKS_BASE)
+    # Re-anchor daily, well before ticks_diff wraps, and to pick up NTP syncs.
+    # A negative offset means ticks wrapped past ticks_diff's range since the
+    # anchor was taken.
+    if _EPOCH_BASE_MS == 0 or elapsed < 0 or elapsed >= 86_400_000:
+        _EPOCH_BASE_MS = utime.time() * 1000
+        _TICKS_BASE = now
+        elapsed = 0
+    return _EPOCH_BASE_MS + elapsed
+
+
 def get_node_id():
     """Generate unique node ID from MAC address."""
     if config.NODE_ID:
         return config.NODE_ID
-    wlan = network.WLAN(network.STA_IF)
-    mac = ubinascii.hexlify(wlan.config("mac")).decode()
+    mac = ubinascii.hexlify(_WLAN_STA.config("mac")).decode()
     return "esp32-" + mac[-6:]
 
 
@@ -97,282 +349,323 @@ def get_platform():
 
 def get_ip():
     """Get current IP address."""
-    wlan = network.WLAN(network.STA_IF)
-    if wlan.isconnected():
-        return wlan.ifconfig()[0]
+    if _WLAN_STA.isconnected():
+        return _WLAN_STA.ifconfig()[0]
     return "0.0.0.0"
 
 
+def optional_module(name):
+    """Import an optional module once and keep it; returns None if missing."""
+    try:
+        return _MODS[name]
+    except KeyError:
+        pass
+    try:
+        mod = __import__(name)
+    except ImportError:
+        mod = None
+    _MODS[name] = mod
+    return mod
+
+
 def collect_sysinfo():
-    """Collect system information from ESP32."""
+    """Collect system information from ESP32 into a reused dict."""
+    global _FS_BSIZE, _DISK_TOTAL_MB, _FREQ_MHZ
+    info = _SYSINFO_INFO
+
     gc.collect()
     free_mem = gc.mem_free()
     alloc_mem = gc.mem_alloc()
     total_mem = free_mem + alloc_mem
 
-    # Filesystem info
+    # Static fields, filled on the first call
+    if not info:
+        info["hostname"] = config.NODE_NAME
+        info["cpuPercent"] = 0  # Not easily measurable on ESP32
+        info["diskTotalGB"] = 0
+
+    # Filesystem info (block size and total are fixed, only free blocks change;
+    # the geometry is kept once statvfs has succeeded)
+    disk_free = 0
     try:
         stat = os.statvfs("/")
-        disk_total = stat[0] * stat[2] / (1024 * 1024)  # MB
-        disk_free = stat[0] * stat[3] / (1024 * 1024)    # MB
+        if not _FS_BSIZE:
+            _FS_BSIZE = stat[0]
+            _DISK_TOTAL_MB = stat[0] * stat[2] / (1024 * 1024)
+            info["diskTotalGB"] = round(_DISK_TOTAL_MB / 1024, 3)
+        disk_free = _FS_BSIZE * stat[3] / (1024 * 1024)  # MB
     except:
-        disk_total = 0
-        disk_free = 0
-
-    # CPU frequency
-    freq_mhz = machine.freq() / 1_000_000
-
-    info = {
-        "hostname": config.NODE_NAME,
-        "ipAddress": get_ip(),
-        "memTotalMB": round(total_mem / (1024 * 1024), 2),
-        "memUsedMB": round(alloc_mem / (1024 * 1024), 2),
-        "diskTotalGB": round(disk_total / 1024, 3),
-        "diskUsedGB": round((disk_total - disk_free) / 1024, 3),
-        "uptimeSeconds": utime.ticks_ms() // 1000,
-        "cpuPercent": 0,  # Not easily measurable on ESP32
-    }
+        pass
+
+    # CPU frequency only changes through the freq command, which clears the cache
+    if _FREQ_MHZ is None:
+        _FREQ_MHZ = machine.freq() / 1_000_000
+
+    info["ipAddress"] = get_ip()
+    info["memTotalMB"] = round(total_mem / (1024 * 1024), 2)
+    info["memUsedMB"] = round(alloc_mem / (1024 * 1024), 2)
+    info["diskUsedGB"] = round((_DISK_TOTAL_MB - disk_free) / 1024, 3)
+    info["uptimeSeconds"] = utime.ticks_ms() // 1000
 
     # Temperature (ESP32 has internal temp sensor)
-    try:
-        import esp32
-        info["tempCelsius"] = round(esp32.raw_temperature() * 0.01, 1)  # Rough conversion
-    except:
-        pass
+    esp32 = optional_module("esp32")
+    if esp32:
+        try:
+            info["tempCelsius"] = round(esp32.raw_temperature() * 0.01, 1)  # Rough conversion
+        except:
+            info.pop("tempCelsius", None)  # Don't report the last reading
 
     # Add CPU frequency as extra data
-    info["cpuFreqMHz"] = freq_mhz
+    info["cpuFreqMHz"] = _FREQ_MHZ
 
     return info
 
 
 def detect_capabilities():
-    """Detect available capabilities on this ESP32."""
+    """Detect available capabilities on this ESP32 (probed once, then cached)."""
+    global _CAPS_CACHE
+    if _CAPS_CACHE is not None:
+        return _CAPS_CACHE
+
     caps = ["shell", "system"]
 
     # GPIO is always available on ESP32
     caps.append("gpio")
 
     # Check for common sensor libraries
-    try:
-        import dht
+    if optional_module("dht"):
         caps.append("sensor")
-    except ImportError:
-        pass
 
     # Check for camera (ESP32-CAM)
-    try:
-        import camera
+    if optional_module("camera"):
         caps.append("camera")
-    except ImportError:
-        pass
 
     # Check for Bluetooth
-    try:
-        import ubluetooth
+    if optional_module("ubluetooth"):
         caps.append("bluetooth")
-    except ImportError:
-        pass
 
     # Check for NeoPixel
-    try:
-        import neopixel
+    if optional_module("neopixel"):
         caps.append("neopixel")
-    except ImportError:
-        pass
 
+    _CAPS_CACHE = caps
     return caps
 
 
 # ─── Command Execution ───────────────────────────────────
+# Each handler takes the argument list and returns (exit_code, stdout, stderr).
 
-def execute_command(cmd, args=None, timeout=10):
-    """Execute a command on the ESP32. Supports special ESP32 commands."""
-    start = utime.ticks_ms()
-    stdout = ""
-    stderr = ""
-    exit_code = 0
+def _cmd_reboot(args):
+    machine.reset()
+    return 0, "Rebooting...", ""
 
-    try:
-        # Special ESP32 commands
-        if cmd == "reboot":
-            stdout = "Rebooting..."
-            machine.reset()
 
-        elif cmd == "mem":
-            gc.collect()
-            stdout = "Free: %d bytes, Allocated: %d bytes, Total: %d bytes" % (
-                gc.mem_free(), gc.mem_alloc(), gc.mem_free() + gc.mem_alloc()
-            )
+def _cmd_mem(args):
+    gc.collect()
+    return 0, "Free: %d bytes, Allocated: %d bytes, Total: %d bytes" % (
+        gc.mem_free(), gc.mem_alloc(), gc.mem_free() + gc.mem_alloc()
+    ), ""
 
-        elif cmd == "freq":
-            if args and len(args) > 0:
-                try:
-                    mhz = int(args[0])
-                    machine.freq(mhz * 1_000_000)
-                    stdout = "CPU frequency set to %d MHz" % mhz
-                except:
-                    stderr = "Invalid frequency"
-                    exit_code = 1
-            else:
-                stdout = "CPU frequency: %d MHz" % (machine.freq() // 1_000_000)
 
-        elif cmd == "gpio_read":
-            if args and len(args) > 0:
-                pin_num = int(args[0])
-                pin = machine.Pin(pin_num, machine.Pin.IN)
-                stdout = "GPIO %d = %d" % (pin_num, pin.value())
-            else:
-                stderr = "Usage: gpio_read <pin>"
-                exit_code = 1
-
-        elif cmd == "gpio_write":
-            if args and len(args) >= 2:
-                pin_num = int(args[0])
-                value = int(args[1])
-                pin = machine.Pin(pin_num, machine.Pin.OUT)
-                pin.value(value)
-                stdout = "GPIO %d set to %d" % (pin_num, value)
-            else:
-                stderr = "Usage: gpio_write <pin> <0|1>"
-                exit_code = 1
-
-        elif cmd == "led":
-            if args and len(args) > 0:
-                value = int(args[0])
-                led = machine.Pin(config.LED_PIN, machine.Pin.OUT)
-                led.value(value)
-                stdout = "LED %s" % ("ON" if value else "OFF")
-            else:
-                stderr = "Usage: led <0|1>"
-                exit_code = 1
-
-        elif cmd == "pwm":
-            if args and len(args) >= 2:
-                pin_num = int(args[0])
-                duty = int(args[1])
-                pin = machine.Pin(pin_num, machine.Pin.OUT)
-                pwm = machine.PWM(pin)
-                pwm.duty(duty)
-                stdout = "PWM on GPIO %d, duty=%d" % (pin_num, duty)
-            else:
-                stderr = "Usage: pwm <pin> <duty 0-1023>"
-                exit_code = 1
-
-        elif cmd == "adc_read":
-            if args and len(args) > 0:
-                pin_num = int(args[0])
-                adc = machine.ADC(machine.Pin(pin_num))
-                adc.atten(machine.ADC.ATTN_11DB)
-                value = adc.read()
-                stdout = "ADC GPIO %d = %d (0-4095)" % (pin_num, value)
-            else:
-                stderr = "Usage: adc_read <pin>"
-                exit_code = 1
+def _cmd_freq(args):
+    global _FREQ_MHZ
+    if args and len(args) > 0:
+        try:
+            mhz = int(args[0])
+            machine.freq(mhz * 1_000_000)
+            _FREQ_MHZ = None
+            return 0, "CPU frequency set to %d MHz" % mhz, ""
+        except:
+            return 1, "", "Invalid frequency"
+    return 0, "CPU frequency: %d MHz" % (machine.freq() // 1_000_000), ""
+
+
+def _cmd_gpio_read(args):
+    if args and len(args) > 0:
+        pin_num = int(args[0])
+        pin = machine.Pin(pin_num, machine.Pin.IN)
+        return 0, "GPIO %d = %d" % (pin_num, pin.value()), ""
+    return 1, "", "Usage: gpio_read <pin>"
+
+
+def _cmd_gpio_write(args):
+    if args and len(args) >= 2:
+        pin_num = int(args[0])
+        value = int(args[1])
+        pin = machine.Pin(pin_num, machine.Pin.OUT)
+        pin.value(value)
+        return 0, "GPIO %d set to %d" % (pin_num, value), ""
+    return 1, "", "Usage: gpio_write <pin> <0|1>"
+
+
+def _cmd_led(args):
+    if args and len(args) > 0:
+        value = int(args[0])
+        led = machine.Pin(config.LED_PIN, machine.Pin.OUT)
+        led.value(value)
+        return 0, "LED %s" % ("ON" if value else "OFF"), ""
+    return 1, "", "Usage: led <0|1>"
+
+
+def _cmd_pwm(args):
+    if args and len(args) >= 2:
+        pin_num = int(args[0])
+        duty = int(args[1])
+        pin = machine.Pin(pin_num, machine.Pin.OUT)
+        pwm = machine.PWM(pin)
+        pwm.duty(duty)
+        return 0, "PWM on GPIO %d, duty=%d" % (pin_num, duty), ""
+    return 1, "", "Usage: pwm <pin> <duty 0-1023>"
+
+
+def _cmd_adc_read(args):
+    if args and len(args) > 0:
+        pin_num = int(args[0])
+        adc = machine.ADC(machine.Pin(pin_num))
+        adc.atten(machine.ADC.ATTN_11DB)
+        value = adc.read()
+        return 0, "ADC GPIO %d = %d (0-4095)" % (pin_num, value), ""
+    return 1, "", "Usage: adc_read <pin>"
+
+
+def _cmd_temp(args):
+    esp32 = optional_module("esp32")
+    if esp32:
+        try:
+            raw = esp32.raw_temperature()
+            # ESP32 internal temp (Fahrenheit by default on some firmware)
+            return 0, "Internal temperature: raw=%d" % raw, ""
+        except:
+            pass
+    return 1, "", "Temperature sensor not available"
+
+
+def _cmd_dht(args):
+    if args and len(args) > 0:
+        dht = optional_module("dht")
+        if not dht:
+            return 1, "", "DHT library not available"
+        pin_num = int(args[0])
+        sensor_type = args[1] if len(args) > 1 else "22"
+        pin = machine.Pin(pin_num)
+        if sensor_type == "11":
+            d = dht.DHT11(pin)
+        else:
+            d = dht.DHT22(pin)
+        d.measure()
+        return 0, "Temperature: %.1f°C, Humidity: %.1f%%" % (d.temperature(), d.humidity()), ""
+    return 1, "", "Usage: dht <pin> [11|22]"
+
+
+def _cmd_scan_wifi(args):
+    _WLAN_STA.active(True)
+    networks = _WLAN_STA.scan()
+    parts = ["WiFi networks:"]
+    for i, net in enumerate(networks):
+        if i >= 10:
+            break
+        parts.append("\n  ")
+        parts.append(net[0].decode())
+        parts.append(" (RSSI: ")
+        parts.append(str(net[3]))
+        parts.append(")")
+    return 0, "".join(parts), ""
+
+
+def _cmd_ls(args):
+    path = args[0] if args and len(args) > 0 else "/"
+    try:
+        files = os.listdir(path)
+        return 0, "\n".join(files), ""
+    except:
+        return 1, "", "Cannot list: %s" % path
 
-        elif cmd == "temp":
-            try:
-                import esp32
-                raw = esp32.raw_temperature()
-                # ESP32 internal temp (Fahrenheit by default on some firmware)
-                stdout = "Internal temperature: raw=%d" % raw
-            except:
-                stderr = "Temperature sensor not available"
-                exit_code = 1
 
-        elif cmd == "dht":
-            if args and len(args) > 0:
-                try:
-                    import dht
-                    pin_num = int(args[0])
-                    sensor_type = args[1] if len(args) > 1 else "22"
-                    pin = machine.Pin(pin_num)
-                    if sensor_type == "11":
-                        d = dht.DHT11(pin)
-                    else:
-                        d = dht.DHT22(pin)
-                    d.measure()
-                    stdout = "Temperature: %.1f°C, Humidity: %.1f%%" % (d.temperature(), d.humidity())
-                except ImportError:
-                    stderr = "DHT library not available"
-                    exit_code = 1
-            else:
-                stderr = "Usage: dht <pin> [11|22]"
-                exit_code = 1
-
-        elif cmd == "scan_wifi":
-            wlan = network.WLAN(network.STA_IF)
-            wlan.active(True)
-            networks = wlan.scan()
-            lines = []
-            for net in networks[:10]:
-                ssid = net[0].decode()
-                rssi = net[3]
-                lines.append("  %s (RSSI: %d)" % (ssid, rssi))
-            stdout = "WiFi networks:\n" + "\n".join(lines)
-
-        elif cmd == "ls":
-            path = args[0] if args and len(args) > 0 else "/"
-            try:
-                files = os.listdir(path)
-                stdout = "\n".join(files)
-            except:
-                stderr = "Cannot list: %s" % path
-                exit_code = 1
+def _decode_text(data):
+    """Decode file bytes for display (MicroPython ignores errors="replace")."""
+    for cut in range(4):  # A multi-byte character may be split at the read limit
+        try:
+            return (data[:-cut] if cut else data).decode("utf-8", "replace")
+        except UnicodeError:
+            pass
+    return str(data)[2:-1]  # Binary data, shown escaped
 
-        elif cmd == "cat":
-            if args and len(args) > 0:
-                try:
-                    with open(args[0], "r") as f:
-                        stdout = f.read()[:2048]  # Limit output
-                except:
-                    stderr = "Cannot read: %s" % args[0]
-                    exit_code = 1
-            else:
-                stderr = "Usage: cat <file>"
-                exit_code = 1
 
-        elif cmd == "exec":
-            # Execute arbitrary MicroPython code
-            if args and len(args) > 0:
-                code = " ".join(args)
-                try:
-                    exec(code)
-                    stdout = "Executed: %s" % code
-                except Exception as e:
-                    stderr = str(e)
-                    exit_code = 1
-            else:
-                stderr = "Usage: exec <python code>"
-                exit_code = 1
-
-        elif cmd == "help":
-            stdout = (
-                "Available commands:\n"
-                "  reboot         — Restart ESP32\n"
-                "  mem            — Show memory usage\n"
-                "  freq [mhz]    — Get/set CPU frequency\n"
-                "  gpio_read <p>  — Read GPIO pin\n"
-                "  gpio_write <p> <v> — Write GPIO pin\n"
-                "  led <0|1>      — Toggle built-in LED\n"
-                "  pwm <p> <duty> — Set PWM on pin\n"
-                "  adc_read <p>   — Read ADC value\n"
-                "  temp           — Internal temperature\n"
-                "  dht <p> [type] — Read DHT sensor\n"
-                "  scan_wifi      — Scan WiFi networks\n"
-                "  ls [path]      — List files\n"
-                "  cat <file>     — Read file\n"
-                "  exec <code>    — Execute MicroPython\n"
-                "  help           — Show this help"
-            )
+def _cmd_cat(args):
+    if args and len(args) > 0:
+        try:
+            with open(args[0], "rb") as f:
+                data = f.read(2048)  # Limit output without loading the whole file
+        except:
+            return 1, "", "Cannot read: %s" % args[0]
+        return 0, _decode_text(data), ""
+    return 1, "", "Usage: cat <file>"
+
+
+def _cmd_exec(args):
+    # Execute arbitrary MicroPython code
+    if args and len(args) > 0:
+        code = " ".join(args)
+        try:
+            exec(code)
+            return 0, "Executed: %s" % code, ""
+        except Exception as e:
+            return 1, "", str(e)
+    return 1, "", "Usage: exec <python code>"
+
+
+def _cmd_help(args):
+    return 0, (
+        "Available commands:\n"
+        "  reboot         — Restart ESP32\n"
+        "  mem            — Show memory usage\n"
+        "  freq [mhz]    — Get/set CPU frequency\n"
+        "  gpio_read <p>  — Read GPIO pin\n"
+        "  gpio_write <p> <v> — Write GPIO pin\n"
+        "  led <0|1>      — Toggle built-in LED\n"
+        "  pwm <p> <duty> — Set PWM on pin\n"
+        "  adc_read <p>   — Read ADC value\n"
+        "  temp           — Internal temperature\n"
+        "  dht <p> [type] — Read DHT sensor\n"
+        "  scan_wifi      — Scan WiFi networks\n"
+        "  ls [path]      — List files\n"
+        "  cat <file>     — Read file\n"
+        "  exec <code>    — Execute MicroPython\n"
+        "  help           — Show this help"
+    ), ""
+
+
+_CMDS = {
+    "reboot": _cmd_reboot,
+    "mem": _cmd_mem,
+    "freq": _cmd_freq,
+    "gpio_read": _cmd_gpio_read,
+    "gpio_write": _cmd_gpio_write,
+    "led": _cmd_led,
+    "pwm": _cmd_pwm,
+    "adc_read": _cmd_adc_read,
+    "temp": _cmd_temp,
+    "dht": _cmd_dht,
+    "scan_wifi": _cmd_scan_wifi,
+    "ls": _cmd_ls,
+    "cat": _cmd_cat,
+    "exec": _cmd_exec,
+    "help": _cmd_help,
+}
 
-        else:
-            stderr = "Unknown command: %s. Type 'help' for available commands." % cmd
-            exit_code = 127
 
+def execute_command(cmd, args=None, timeout=10):
+    """Execute a command on the ESP32. Supports special ESP32 commands."""
+    start = utime.ticks_ms()
+
+    handler = _CMDS.get(cmd)
+    if handler is None:
+        return 127, "", "Unknown command: %s. Type 'help' for available commands." % cmd, 0
+
+    try:
+        exit_code, stdout, stderr = handler(args)
     except Exception as e:
-        stderr = str(e)
-        exit_code = 1
+        exit_code, stdout, stderr = 1, "", str(e)
 
     duration = utime.ticks_diff(utime.ticks_ms(), start)
     return exit_code, stdout, stderr, duration
@@ -383,18 +676,26 @@ def execute_command(cmd, args=None, timeout=10):
 class ForgeAINodeAgent:
     def __init__(self):
         self.node_id = get_node_id()
+        self.capabilities = detect_capabilities()
         self.ws = None
         self.sock = None
+        self.poller = None
         self.session_id = None
         self.connected = False
         self.last_heartbeat = 0
         self.last_sysinfo = 0
 
+        # Let the allocator trigger collections once a quarter of the free
+        # heap has been used, instead of collecting on every loop pass.
+        gc.collect()
+        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
     def now_ms(self):
         return utime.ticks_ms()
 
     def connect(self):
         """Connect to ForgeAI Gateway via WebSocket."""
+        global _EPOCH_BASE_MS
         print("[ForgeAI] Connecting to %s:%d ..." % (config.GATEWAY_HOST, config.GATEWAY_PORT))
 
         try:
@@ -406,24 +707,32 @@ class ForgeAINodeAgent:
             )
             print("[ForgeAI] WebSocket connected!")
 
+            # Take a fresh wall-clock anchor for this session; the old one may
+            # predate a long outage, beyond the range of ticks_diff().
+            _EPOCH_BASE_MS = 0
+
             # Send auth
             auth_msg = {
                 "type": "auth",
-                "ts": utime.time() * 1000,
+                "ts": epoch_ms(),
                 "token": config.NODE_TOKEN,
                 "node": {
                     "nodeId": self.node_id,
                     "name": config.NODE_NAME,
                     "platform": get_platform(),
                     "version": VERSION,
-                    "capabilities": detect_capabilities(),
+                    "capabilities": self.capabilities,
                     "tags": config.NODE_TAGS,
                 },
             }
             ws_send_json(self.ws, auth_msg)
             print("[ForgeAI] Auth sent, waiting for response...")
 
-            # Wait for auth response (blocking, with timeout)
+            # Reads are non-blocking from here on and driven by poll()
+            self.poller = uselect.poll()
+            self.poller.register(self.sock, uselect.POLLIN)
+
+            # Wait for auth response (with timeout)
             start = utime.ticks_ms()
             while utime.ticks_diff(utime.ticks_ms(), start) < 5000:
                 msg = ws_recv_json(self.ws)
@@ -437,7 +746,7 @@ class ForgeAINodeAgent:
                         print("[ForgeAI] Auth FAILED:", msg.get("message", "unknown"))
                         self.close()
                         return False
-                utime.sleep_ms(100)
+                self.poller.poll(100)
 
             print("[ForgeAI] Auth timeout!")
             self.close()
@@ -451,6 +760,7 @@ class ForgeAINodeAgent:
     def close(self):
         """Close WebSocket connection."""
         self.connected = False
+        self.poller = None
         if self.ws:
             try:
                 self.ws.close()
@@ -466,10 +776,14 @@ class ForgeAINodeAgent:
 
     def send(self, msg):
         """Send a message to Gateway."""
+        return self.send_raw(ujson.dumps(msg))
+
+    def send_raw(self, payload):
+        """Send an already serialized message to Gateway."""
         if not self.ws:
             return False
         try:
-            ws_send_json(self.ws, msg)
+            self.ws.send(payload)
             return True
         except Exception as e:
             print("[ForgeAI] Send error:", e)
@@ -478,16 +792,12 @@ class ForgeAINodeAgent:
 
     def send_heartbeat(self):
         """Send ping heartbeat."""
-        return self.send({"type": "ping", "ts": utime.time() * 1000})
+        return self.send_raw(_PING_TMPL % epoch_ms())
 
     def send_sysinfo(self):
         """Send system info to Gateway."""
-        info = collect_sysinfo()
-        return self.send({
-            "type": "sysinfo",
-            "ts": utime.time() * 1000,
-            "info": info,
-        })
+        info = ujson.dumps(collect_sysinfo()).encode()
+        return self.send_raw(_SYSINFO_TMPL % (epoch_ms(), info))
 
     def handle_message(self, msg):
         """Process incoming message from Gateway."""
@@ -497,7 +807,7 @@ class ForgeAINodeAgent:
             pass  # Heartbeat response, ignore
 
         elif msg_type == "ping":
-            self.send({"type": "pong", "ts": utime.time() * 1000})
+            self.send_raw(_PONG_TMPL % epoch_ms())
 
         elif msg_type == "command":
             cmd = msg.get("cmd", "")
@@ -505,74 +815,107 @@ class ForgeAINodeAgent:
             timeout = msg.get("timeout", 10)
             msg_id = msg.get("msgId", "")
 
-            print("[ForgeAI] Command: %s %s" % (cmd, " ".join(args) if args else ""))
+            if _DEBUG:
+                print("[ForgeAI] Command: %s %s" % (cmd, " ".join(args) if args else ""))
 
             exit_code, stdout, stderr, duration = execute_command(cmd, args, timeout)
 
-            self.send({
-                "type": "command_result",
-                "ts": utime.time() * 1000,
-                "replyTo": msg_id,
-                "exitCode": exit_code,
-                "stdout": stdout[:4096],  # Limit output size
-                "stderr": stderr[:1024],
-                "durationMs": duration,
-            })
+            result = _CMD_RESULT
+            result["ts"] = epoch_ms()
+            result["replyTo"] = msg_id
+            result["exitCode"] = exit_code
+            # Limit output size (only slice when over the limit)
+            result["stdout"] = stdout if len(stdout) <= 4096 else stdout[:4096]
+            result["stderr"] = stderr if len(stderr) <= 1024 else stderr[:1024]
+            result["durationMs"] = duration
+            self.send(result)
+
+            # Drop the output so the collection below can reclaim it
+            result["stdout"] = ""
+            result["stderr"] = ""
+            gc.collect()
 
         elif msg_type == "response":
             # AI response from Gateway
-            content = msg.get("content", "")
-            print("[ForgeAI] AI:", content[:200])
+            if _DEBUG:
+                print("[ForgeAI] AI:", msg.get("content", "")[:200])
 
         elif msg_type == "node_list":
             nodes = msg.get("nodes", [])
             print("[ForgeAI] Connected nodes: %d" % len(nodes))
 
         elif msg_type == "relay":
-            from_id = msg.get("fromNodeId", "?")
-            payload = msg.get("payload", {})
-            print("[ForgeAI] Relay from %s: %s" % (from_id, str(payload)[:100]))
+            if _DEBUG:
+                from_id = msg.get("fromNodeId", "?")
+                payload = msg.get("payload", {})
+                print("[ForgeAI] Relay from %s: %s" % (from_id, str(payload)[:100]))
 
         else:
             print("[ForgeAI] Unknown message type:", msg_type)
 
     def run_loop(self):
-        """Main event loop — non-blocking read + periodic tasks."""
-        self.last_heartbeat = utime.ticks_ms()
-        self.last_sysinfo = utime.ticks_ms()
+        """Main event loop — poll for incoming messages + periodic tasks."""
+        # Bind hot lookups to locals once; the loop body then avoids
+        # global/attribute lookups on every pass.
+        ws = self.ws
+        poll = self.poller.poll
+        recv = ws_recv_json
+        handle = self.handle_message
+        ticks_ms = utime.ticks_ms
+        ticks_diff = utime.ticks_diff
+        hangup = uselect.POLLHUP | uselect.POLLERR
+        hb_ms = config.HEARTBEAT_INTERVAL * 1000
+        si_ms = config.SYSINFO_INTERVAL * 1000
+
+        last_heartbeat = last_sysinfo = ticks_ms()
 
         # Send initial sysinfo
         self.send_sysinfo()
 
+        # Messages that arrived right behind auth_ok are already buffered and
+        # will not wake poll(), so read before the first wait.
+        readable = True
+
         while self.connected:
-            now = utime.ticks_ms()
+            # Handle every complete message received so far
+            if readable:
+                try:
+                    msg = recv(ws)
+                    while msg is not None and self.connected:
+                        handle(msg)
+                        msg = recv(ws)
+                except Exception as e:
+                    print("[ForgeAI] Read error:", e)
+                    self.connected = False
+                    break
 
-            # Read incoming messages
-            try:
-                msg = ws_recv_json(self.ws)
-                if msg:
-                    self.handle_message(msg)
-            except Exception as e:
-                print("[ForgeAI] Read error:", e)
-                self.connected = False
-                break
+            now = ticks_ms()
 
             # Heartbeat
-            if utime.ticks_diff(now, self.last_heartbeat) >= config.HEARTBEAT_INTERVAL * 1000:
+            if ticks_diff(now, last_heartbeat) >= hb_ms:
                 if not self.send_heartbeat():
                     break
-                self.last_heartbeat = now
+                last_heartbeat = now
 
             # System info
-            if utime.ticks_diff(now, self.last_sysinfo) >= config.SYSINFO_INTERVAL * 1000:
+            if ticks_diff(now, last_sysinfo) >= si_ms:
                 self.send_sysinfo()
-                self.last_sysinfo = now
+                last_sysinfo = now
 
-            # Garbage collect periodically
-            gc.collect()
+            # Sleep until data arrives or the next periodic task is due
+            wait = min(
+                hb_ms - ticks_diff(now, last_heartbeat),
+                si_ms - ticks_diff(now, last_sysinfo),
+            )
+            events = poll(max(wait, 0))
+            if events and events[0][1] & hangup:
+                print("[ForgeAI] Connection lost")
+                self.connected = False
+                break
+            readable = bool(events)
 
-            # Small sleep to avoid busy loop
-            utime.sleep_ms(50)
+        self.last_heartbeat = last_heartbeat
+        self.last_sysinfo = last_sysinfo
 
     def run(self):
         """Main entry point with auto-reconnect."""
@@ -583,7 +926,7 @@ class ForgeAINodeAgent:
         print("  ID:       %s" % self.node_id)
         print("  Name:     %s" % config.NODE_NAME)
         print("  Platform: %s" % get_platform())
-        print("  Caps:     %s" % ",".join(detect_capabilities()))
+        print("  Caps:     %s" % ",".join(self.capabilities))
         print("  Gateway:  %s:%d" % (config.GATEWAY_HOST, config.GATEWAY_PORT))
         print("=" * 44)
         print()
@@ -596,12 +939,11 @@ class ForgeAINodeAgent:
                 utime.sleep(delay)
 
             # Check WiFi
-            wlan = network.WLAN(network.STA_IF)
-            if not wlan.isconnected():
+            if not _WLAN_STA.isconnected():
                 print("[ForgeAI] WiFi disconnected, reconnecting...")
                 from boot import connect_wifi
                 connect_wifi()
-                if not wlan.isconnected():
+                if not _WLAN_STA.isconnected():
                     attempt += 1
                     continue
 
@@ -0,0 +1,7 @@
+# ForgeAI Node Agent — ESP32 frozen firmware manifest
+# Bakes main.py into the firmware image as precompiled bytecode.
+# config.py and boot.py stay on the filesystem so they can still be edited.
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+module("main.py", opt=3)